@@ -2,22 +2,32 @@ import os
 import base64
 import string
 import random
-import hashlib
 import operator
 import time
 import asyncio
 import collections
+import functools
 import heapq
 import struct
+import weakref
 import json
+import logging
 import umsgpack
 import psutil
 from _typing import *
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # type: ignore
+
 
 BYTE_ORDER: str = "I"
 MAX_LONG: int = 2 ** 125
 KSIZE: int = 3
+STORE_BATCH_SIZE: int = 64
+
+logger = logging.getLogger(__name__)
 
 if os.environ.get("ENVIRONMENT") == "dev":
     MAX_LONG = 10
@@ -31,17 +41,39 @@ TMessageFuture = Tuple[asyncio.Future, asyncio.Handle]
 
 
 async def gather_coros(d):
+    if len(d) == 1:
+        # nothing to run concurrently, skip gather's task wrapping
+        key, coro = next(iter(d.items()))
+        return {key: await coro}
+
     coros = list(d.values())
     results = await asyncio.gather(*coros)
     return dict(zip(d.keys(), results))
 
 
-def to_addr(h: str, p: int) -> str:
-    return h + ":" + str(p)
+def install_uvloop() -> bool:
+    """
+    Swap asyncio's default event loop policy for uvloop's when uvloop is
+    installed. Must be called before the loop is created
+    """
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
 
 
-def hex_to_int(h: str) -> int:
-    return int(h, 20)
+def run(main: Coroutine[Any, Any, T]) -> T:
+    """
+    Run `main` on a fresh event loop (uvloop's when available) until it
+    completes. Cancellation and loop shutdown on Ctrl-C are handled by
+    asyncio.run
+    """
+    install_uvloop()
+    return asyncio.run(main)
+
+
+def to_addr(h: str, p: int) -> str:
+    return h + ":" + str(p)
 
 
 def pack(s: str) -> bytes:
@@ -49,6 +81,16 @@ def pack(s: str) -> bytes:
     return struct.pack(BYTE_ORDER, len(b)) + b
 
 
+@functools.lru_cache(maxsize=8192)
+def key_digest(key: str) -> Tuple[bytes, int]:
+    """
+    The packed digest of a key along with its long_id, memoized since the
+    same keys are turned into nodes over and over during republish/refresh
+    """
+    digest = pack(key)
+    return digest, int.from_bytes(digest, "big")
+
+
 def unpack(b: bytes) -> Any:
     size = struct.calcsize(BYTE_ORDER)
     return struct.unpack(BYTE_ORDER, b[:size]), b[size:]
@@ -73,14 +115,15 @@ def random_string(n: int = 10) -> str:
 
 
 class BaseNode:
+    __slots__ = ("key", "digest", "payload", "_long_id", "__weakref__")
+
     def __init__(self, key: str):
         self.key = key
-        self.digest = pack(self.key)
+        self.digest, self._long_id = key_digest(self.key)
         self.payload: Dict[str, bytes] = {}
-        self._long_id = hex_to_int(self.digest.hex())
 
     def distance_to(self, other) -> int:
-        x: int = self.long_id ^ other.long_id
+        x: int = self._long_id ^ other.long_id
         return x
 
     @property
@@ -90,7 +133,7 @@ class BaseNode:
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, BaseNode):
             raise NotImplementedError
-        return other.key == self.key
+        return other.long_id == self._long_id
 
     def __iter__(self) -> Iterator[object]:
         return iter((self.long_id, self.key, self.payload))
@@ -103,20 +146,31 @@ class BaseNode:
 
 
 class PeerNode(BaseNode):
+    __slots__ = ("_addr",)
+
+    def __init__(self, key: str):
+        super().__init__(key)
+        self._addr: Optional[TAddress] = None
+
     def set_payload(self, payload: Any):
         # payload can be a socket connection or what have out
         self.payload = payload
 
     @property
-    def addr(self) -> Tuple[str, int]:
-        host, port = self.key.split(":")
-        return (host, int(port))
+    def addr(self) -> TAddress:
+        # parsed lazily since not every peer key is a host:port pair
+        if self._addr is None:
+            host, port = self.key.split(":")
+            self._addr = (host, int(port))
+        return self._addr
 
     def serialize(self) -> str:
         return json.dumps({"key": self.key, "long_id": self.long_id, "value": self.payload})
 
 
 class CacheNode(BaseNode):
+    __slots__ = ()
+
     def set_payload(self, payload: Dict[str, bytes] = {}):
         self.payload = payload
 
@@ -125,6 +179,21 @@ class CacheNode(BaseNode):
         return json.dumps({"key": self.key, "long_id": self.long_id, "value": payload})
 
 
+_peer_nodes: "weakref.WeakValueDictionary[str, PeerNode]" = weakref.WeakValueDictionary()
+
+
+def get_peer_node(key: str) -> PeerNode:
+    """
+    Hand back the live PeerNode for `key` if there is one rather than
+    building a new node for every datagram a peer sends us
+    """
+    node = _peer_nodes.get(key)
+    if node is None:
+        node = PeerNode(key=key)
+        _peer_nodes[key] = node
+    return node
+
+
 TNode = TypeVar("TNode", bound=BaseNode)
 THashCacheKey = TypeVar("THashCacheKey", bound=Union[BaseNode, str, int])
 
@@ -177,52 +246,137 @@ class HashCache(Generic[T]):
 
 
 class NodeHeap(Generic[TNode]):
+    """
+    Keeps the `max_size` nodes closest to `source_node`. Entries are stored as
+    (-distance, node) so the heap's root is the furthest node kept, which is
+    the one evicted when a closer node is pushed into a full heap
+
+    Evicted nodes aren't thrown away outright, the closest `max_size` of them
+    are kept as spares so that nodes removed from the heap (e.g. peers that
+    failed to respond during a crawl) can be replaced
+    """
+
+    __slots__ = ("source_node", "heap", "contacted", "max_size", "_ids", "_removed", "_spares")
+
+    BATCH_PUSH_SIZE = 4
+
     def __init__(self, source_node: TNode, max_size: int):
         self.source_node = source_node
         self.heap: List[Tuple[int, TNode]] = []
         self.contacted: Set[TNode] = set()
         self.max_size = max_size
+        self._ids: Dict[int, TNode] = {}
+        self._removed: Set[int] = set()
+        self._spares: Dict[int, TNode] = {}
+
+    def push(self, nodes: Iterable[TNode] = ()):
+        source_long_id = self.source_node.long_id
+        ids, removed, spares = self._ids, self._removed, self._spares
+        entries: List[Tuple[int, TNode]] = []
+        for node in nodes:
+            long_id = node.long_id
+            if long_id in ids or long_id in spares:
+                continue
+            ids[long_id] = node
+            if long_id in removed:
+                # the tombstoned entry is still in the heap, just revive it
+                removed.discard(long_id)
+                continue
+            entries.append((-(source_long_id ^ long_id), node))
 
-    def push(self, nodes: List[TNode] = []):
-        while nodes:
-            node = nodes.pop()
-            if node not in self:
-                distance = self.source_node.distance_to(node)
-                heapq.heappush(self.heap, (distance, node))
-
-    def remove(self, nodes: List[str]):
-        if not nodes:
+        if not entries:
             return
-        node_heap: List[Tuple[int, TNode]] = []
-        for distance, node in self.heap:
-            if node not in nodes:
-                heapq.heappush(node_heap, (distance, node))
-        self.heap = node_heap
+
+        # tombstones must not hold on to slots that live nodes could use
+        if removed and len(self.heap) + len(entries) > self.max_size:
+            self._compact()
+
+        # bulk inserts (whole buckets, crawl rounds) are cheaper as one heapify
+        if len(entries) > NodeHeap.BATCH_PUSH_SIZE:
+            self.heap.extend(entries)
+            heapq.heapify(self.heap)
+            while len(self.heap) > self.max_size:
+                _, furthest = heapq.heappop(self.heap)
+                spares[furthest.long_id] = ids.pop(furthest.long_id)
+        else:
+            for entry in entries:
+                if len(self.heap) < self.max_size:
+                    heapq.heappush(self.heap, entry)
+                    continue
+                _, furthest = heapq.heappushpop(self.heap, entry)
+                spares[furthest.long_id] = ids.pop(furthest.long_id)
+
+        if len(spares) > self.max_size:
+            closest = heapq.nsmallest(self.max_size, spares, key=lambda long_id: long_id ^ source_long_id)
+            self._spares = {long_id: spares[long_id] for long_id in closest}
+
+    def remove(self, nodes: List[TNode]):
+        """
+        Removed nodes are tombstoned rather than filtered out of the heap, the
+        heap itself is only rebuilt once tombstones make up half of it
+        """
+        for node in nodes:
+            self._spares.pop(node.long_id, None)
+            if self._ids.pop(node.long_id, None) is not None:
+                self._removed.add(node.long_id)
+
+        if len(self._removed) > len(self.heap) // 2:
+            self._compact()
+
+        self._refill()
+
+    def _refill(self):
+        # promote the closest spares into slots freed up by removals
+        source_long_id = self.source_node.long_id
+        while self._spares and len(self._ids) < self.max_size:
+            long_id = min(self._spares, key=lambda long_id: long_id ^ source_long_id)
+            self.push([self._spares.pop(long_id)])
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if entry[1].long_id not in self._removed]
+        heapq.heapify(self.heap)
+        self._removed.clear()
+
+    def popleft(self) -> Optional[TNode]:
+        if not self._ids:
+            return None
+        node = next(iter(self))
+        self.remove([node])
+        return node
+
+    def get_node(self, long_id: int) -> Optional[TNode]:
+        return self._ids.get(long_id)
+
+    def k_closest(self, target_long_id: int, k: int) -> List[TNode]:
+        # rank on the raw long_id keys of the index, no tuples or node lookups
+        long_ids = heapq.nsmallest(k, self._ids, key=lambda long_id: long_id ^ target_long_id)
+        return [self._ids[long_id] for long_id in long_ids]
 
     def has_exhausted_contacts(self) -> bool:
-        return len(self.uncontacted()) == 0
+        # order doesn't matter here, so don't sort
+        removed, contacted = self._removed, self.contacted
+        return all(node.long_id in removed or node in contacted for _, node in self.heap)
 
     def uncontacted(self) -> List[TNode]:
-        return [n for n in self if n not in self.contacted]
+        removed, contacted = self._removed, self.contacted
+        nodes = sorted(self.heap, key=operator.itemgetter(0), reverse=True)
+        return [node for _, node in nodes if node.long_id not in removed and node not in contacted]
 
     def mark_contacted(self, node: TNode):
         self.contacted.add(node)
 
     def ids(self) -> Set[str]:
-        return set([node.key for node in map(operator.itemgetter(1), self.heap)])
+        return set([node.key for node in self._ids.values()])
 
     def __len__(self) -> int:
-        return min(len(self.heap), self.max_size)
+        return len(self._ids)
 
     def __iter__(self):
-        nodes = heapq.nsmallest(self.max_size, self.heap)
-        return iter(map(operator.itemgetter(1), nodes))
+        nodes = sorted(self.heap, key=operator.itemgetter(0), reverse=True)
+        return iter([node for _, node in nodes if node.long_id not in self._removed])
 
     def __contains__(self, n: TNode) -> bool:
-        for _, other in self.heap:
-            if n == other:
-                return True
-        return False
+        return n.long_id in self._ids
 
 
 class KBucket(Generic[TNode]):
@@ -320,30 +474,162 @@ class KBucket(Generic[TNode]):
         return len(self.main_set)
 
 
-class RoutingTable:
+class TrieNode:
+    __slots__ = ("children", "nodes")
+
+    def __init__(self):
+        self.children: List["TrieNode"] = []
+        # None once the node has been split into children
+        self.nodes: Optional[Dict[int, Any]] = {}
+
+
+class XORTrie(Generic[TNode]):
+    """
+    Binary trie over the bits of each node's long_id, most significant bit
+    first. Leaves hold up to `leaf_size` nodes and split once they overflow,
+    the same way k-buckets do, so finding the closest nodes to a target only
+    visits the subtrees sharing the longest prefix with it
+    """
+
+    def __init__(self, leaf_size: int):
+        self.leaf_size = leaf_size
+        self.width = 0
+        self.root = TrieNode()
+        self._size = 0
+
+    def insert(self, node: TNode):
+        long_id = node.long_id
+        if long_id.bit_length() > self.width:
+            # round up to whole bytes so that ids of similar length don't
+            # each trigger a rebuild
+            self._rebuild((long_id.bit_length() + 7) // 8 * 8)
+
+        leaf, depth = self._find_leaf(long_id)
+        if long_id not in leaf.nodes:  # type: ignore
+            self._size += 1
+        leaf.nodes[long_id] = node  # type: ignore
+        self._split(leaf, depth)
+
+    def remove(self, node: TNode):
+        if node.long_id.bit_length() > self.width:
+            return
+        leaf, _ = self._find_leaf(node.long_id)
+        if leaf.nodes.pop(node.long_id, None) is not None:  # type: ignore
+            self._size -= 1
+
+    def neighbors(self, target_long_id: int, k: int, exclude: Optional[TNode] = None) -> List[TNode]:
+        """
+        Walk the trie depth first, always descending into the child matching
+        the target's bit before its sibling. Every node under a sibling is
+        further from the target than every node under the matching child, so
+        once k candidates have been collected the rest of the trie can be
+        skipped
+        """
+        exclude_id = exclude.long_id if exclude is not None else None
+        # max-heap of (-distance, node) holding the k closest seen so far
+        closest: List[Tuple[int, TNode]] = []
+        stack = [(self.root, 0)]
+
+        while stack and len(closest) < k:
+            trie_node, depth = stack.pop()
+            if trie_node.nodes is not None:
+                for long_id, node in trie_node.nodes.items():
+                    if long_id == exclude_id:
+                        continue
+                    entry = (-(long_id ^ target_long_id), node)
+                    if len(closest) < k:
+                        heapq.heappush(closest, entry)
+                    else:
+                        heapq.heappushpop(closest, entry)
+                continue
+
+            bit = (target_long_id >> (self.width - 1 - depth)) & 1
+            stack.append((trie_node.children[bit ^ 1], depth + 1))
+            stack.append((trie_node.children[bit], depth + 1))
+
+        closest.sort(key=operator.itemgetter(0), reverse=True)
+        return [node for _, node in closest]
+
+    def _find_leaf(self, long_id: int) -> Tuple[TrieNode, int]:
+        trie_node, depth = self.root, 0
+        while trie_node.nodes is None:
+            bit = (long_id >> (self.width - 1 - depth)) & 1
+            trie_node = trie_node.children[bit]
+            depth += 1
+        return trie_node, depth
+
+    def _split(self, leaf: TrieNode, depth: int):
+        while len(leaf.nodes) > self.leaf_size and depth < self.width:  # type: ignore
+            shift = self.width - 1 - depth
+            zero, one = TrieNode(), TrieNode()
+            for long_id, node in leaf.nodes.items():  # type: ignore
+                child = one if (long_id >> shift) & 1 else zero
+                child.nodes[long_id] = node  # type: ignore
+
+            leaf.children = [zero, one]
+            leaf.nodes = None
+
+            # only one side can still be overflowing
+            leaf = one if len(one.nodes) > len(zero.nodes) else zero  # type: ignore
+            depth += 1
+
+    def _rebuild(self, width: int):
+        nodes = list(self)
+        self.width = width
+        self.root = TrieNode()
+        self._size = 0
+        for node in nodes:
+            self.insert(node)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[TNode]:
+        stack = [self.root]
+        while stack:
+            trie_node = stack.pop()
+            if trie_node.nodes is None:
+                stack.extend(trie_node.children)
+            else:
+                yield from trie_node.nodes.values()
+
+
+class RoutingTable(Generic[TNode]):
     def __init__(self, protocol, ksize: int, source_node: TNode, max_long: int = MAX_LONG):
         self.protocol = protocol
         self.ksize = ksize
         self.buckets: List[KBucket[TNode]] = []
+        self.trie: XORTrie[TNode] = XORTrie(ksize)
         self.source_node = source_node
         self.max_long = max_long
         self.flush()
 
     def flush(self):
         self.buckets = [KBucket(0, MAX_LONG, self.ksize)]
+        self.trie = XORTrie(self.ksize)
 
     def split_bucket(self, index: int):
         one, two = self.buckets[index].split()
         self.buckets[index] = one
         self.buckets.insert(index + 1, two)
 
+        # splitting can move replacement nodes into the new main sets
+        for node in one.get_main_set() + two.get_main_set():
+            self.trie.insert(node)
+
     def lonely_buckets(self) -> List[KBucket]:
         hr_ago = time.monotonic() - 3600
         return [b for b in self.buckets if b.last_seen < hr_ago and b.has_nodes()]
 
     def remove_node(self, n: TNode):
         index = self.get_bucket_index(n)
-        self.buckets[index].remove_node(n)
+        bucket = self.buckets[index]
+        bucket.remove_node(n)
+
+        # the bucket may have promoted a replacement node into its main set
+        self.trie.remove(n)
+        for node in bucket.get_main_set():
+            self.trie.insert(node)
 
     def is_new_node(self, n: TNode) -> bool:
         index = self.get_bucket_index(n)
@@ -389,6 +675,7 @@ class RoutingTable:
             return
 
         if bucket.add_node(n):
+            self.trie.insert(n)
             return
 
         if bucket.has_in_range(self.source_node) or bucket.depth() % 5 != 0:
@@ -398,61 +685,21 @@ class RoutingTable:
         if bucket.is_full():
             result = asyncio.ensure_future(self.protocol.call_ping(bucket.head))
             if not result:
+                self.trie.remove(bucket.head)
                 bucket.main_set.remove(bucket.head.long_id)
                 bucket.main_set.add(n)
+                self.trie.insert(n)
         return
 
     def find_neighbors(self, n: TNode, k: Optional[int] = None, exclude: Optional[TNode] = None) -> List[TNode]:
         k = k or self.ksize
-        nodes: List[TNode] = []
-
-        for neighbor in TableTraverser(self, n):
-            not_excluded = exclude is None or not neighbor.is_same_node(exclude)
-            if not_excluded:
-                heapq.heappush(nodes, (n.distance_to(neighbor), neighbor))  # type: ignore
-
-            if len(nodes) == k:
-                break
-
-        return list(map(operator.itemgetter(1), heapq.nsmallest(k, nodes)))
+        self.buckets[self.get_bucket_index(n)].set_last_seen()
+        return self.trie.neighbors(n.long_id, k, exclude)
 
     def count_of_nodes_in_table(self) -> int:
         return sum([len(b) for b in self.buckets])
 
 
-class TableTraverser:
-    def __init__(self, table: RoutingTable, start_node: TNode):
-        start_index: int = table.get_bucket_index(start_node)
-        table.buckets[start_index].set_last_seen()
-        self.curr_nodes: List[TNode] = table.buckets[start_index].get_main_set()
-        self.left_buckets = table.buckets[:start_index]
-        self.right_buckets = table.buckets[start_index:]
-        self.left = True
-
-    def __iter__(self):
-        return self
-
-    def __next__(self) -> TNode:
-        if self.curr_nodes:
-            return self.curr_nodes.pop()
-
-        if self.left and self.left_buckets:
-            left_bucket = self.left_buckets.pop()
-            if not left_bucket:
-                raise StopIteration
-
-            self.curr_nodes = left_bucket.get_main_set()
-            self.left = False
-            return next(self)  # type: ignore
-
-        if self.right_buckets:
-            self.curr_nodes = self.right_buckets.pop(0).get_main_set()
-            self.left = True
-            return next(self)  # type: ignore
-
-        raise StopIteration
-
-
 class Datagram:
     MIN_MSG_SIZE = 22
 
@@ -482,7 +729,8 @@ class Datagram:
         self.payload = payload
 
     async def exec_rpc_method(self, rpc_method):
-        return rpc_method(self.sender, *self.args)
+        sender = get_peer_node(to_addr(*self.sender))
+        return rpc_method(sender, *self.args)
 
     def end_fut(self, data: bytes):
         if not self.payload:
@@ -602,7 +850,7 @@ class RPCDatagramProtocol(TDatagramProtocol):
 
         def build_dgram(addr: Tuple[str, int], rpc_args):
             rpc_method_name = name
-            msg_id = hashlib.sha1(os.urandom(32)).digest()
+            msg_id = os.urandom(20)
             data = umsgpack.packb([rpc_method_name, rpc_args])
 
             if len(data) > RPCDatagramProtocol.MAX_RPC_METHOD_SIZE:
@@ -611,7 +859,7 @@ class RPCDatagramProtocol(TDatagramProtocol):
             request = RPCDatagramProtocol.REQUEST + msg_id + data
             self.transport.sendto(request, addr)  # type: ignore
 
-            loop = asyncio.get_event_loop()
+            loop = asyncio.get_running_loop()
             fut = loop.create_future()
             timeout = loop.call_later(self.wait, self.time_msg_out, msg_id)
             msg = Datagram(self.source_node.addr, data=request)
@@ -661,8 +909,8 @@ class RPCContainer:
     def store(self, requestor: PeerNode, payload: CacheNode):
         raise NotImplementedError
 
-    def rpc_stun(self, sender: PeerNode) -> PeerNode:
-        return sender
+    def rpc_stun(self, sender: PeerNode) -> TAddress:
+        return sender.addr
 
     def rpc_ping(self, sender: PeerNode) -> PeerNode:
         self.welcome_node_if_new(sender)
@@ -705,24 +953,55 @@ class RPCContainer:
         if not isinstance(node, PeerNode):
             raise TypeError("welcome_node_if_new called with non-PeerNode")
 
+        source_long_id = self.protocol.source_node.long_id
+        coros = []
         for node_ in self.protocol.storage:
+            long_id = node_.long_id
             neighbors = self.protocol.router.find_neighbors(node_)
             if neighbors:
-                furthest = neighbors[-1].distance_to(node_)
-                is_closer_than_furthest = node.distance_to(node_) < furthest
-                closest_distance_to_new = neighbors[0].distance_to(node_)
-                curr_is_closer = self.protocol.source_node.distance_to(node_) < closest_distance_to_new
+                furthest = neighbors[-1].long_id ^ long_id
+                is_closer_than_furthest = node.long_id ^ long_id < furthest
+                closest_distance_to_new = neighbors[0].long_id ^ long_id
+                curr_is_closer = source_long_id ^ long_id < closest_distance_to_new
 
             if not neighbors or (is_closer_than_furthest and curr_is_closer):
-                asyncio.ensure_future(self.call_store(node, node_))
+                coros.append(self.call_store(node, node_))
+
+        # schedule one task per batch of stores rather than one per key
+        for i in range(0, len(coros), STORE_BATCH_SIZE):
+            batch = coros[i : i + STORE_BATCH_SIZE]
+            stores = asyncio.ensure_future(asyncio.gather(*batch, return_exceptions=True))
+            stores.add_done_callback(self._log_failed_stores)
 
         self.protocol.router.add_node(node)
 
+    def _log_failed_stores(self, stores: asyncio.Future):
+        # gather swallows exceptions with return_exceptions=True, so surface them here
+        if stores.cancelled():
+            return
+        for result in stores.result():
+            if isinstance(result, BaseException):
+                logger.error(
+                    json.dumps(
+                        {
+                            "caller": self.__class__.__name__,
+                            "ts": time.time(),
+                            "details": f"call_store failed while welcoming node: {result!r}",
+                        }
+                    )
+                )
+
     async def call_store(self, requestee: PeerNode, payload: CacheNode):
         result = await self.store(requestee, payload)
-        return self.handle_call_response(result, requestee)
+        if result:
+            self._on_success(requestee)
+            return result
+        return self._on_failure(requestee)
+
+    def _on_success(self, sender):
+        raise NotImplementedError
 
-    def handle_call_response(self, result, sender):
+    def _on_failure(self, sender):
         raise NotImplementedError
 
 
@@ -732,7 +1011,10 @@ TNodeAsTuple = Tuple[int, str, Any]
 class KademliaProtocol(RPCDatagramProtocol, RPCContainer):
     def __init__(self, source_node: PeerNode, storage: CacheStorage, ksize: int, wait: int):
         super(KademliaProtocol, self).__init__(source_node, wait)
-        self.router = RoutingTable(self, ksize, source_node)
+        # RPCDatagramProtocol doesn't chain __init__, and the RPCContainer
+        # methods (e.g. welcome_node_if_new) reach us through `self.protocol`
+        RPCContainer.__init__(self, self)
+        self.router: RoutingTable[BaseNode] = RoutingTable(self, ksize, source_node)
         self.storage = storage
         self.ksize = ksize
 
@@ -751,8 +1033,8 @@ class KademliaProtocol(RPCDatagramProtocol, RPCContainer):
             nodes.append(n)
         return nodes
 
-    def rpc_stun(self, sender: PeerNode) -> PeerNode:
-        return sender
+    def rpc_stun(self, sender: PeerNode) -> TAddress:
+        return sender.addr
 
     def rpc_ping(self, sender: PeerNode) -> PeerNode:
         self.welcome_node_if_new(sender)
@@ -776,12 +1058,18 @@ class KademliaProtocol(RPCDatagramProtocol, RPCContainer):
 
     async def call_find_node(self, to_find: TNode) -> List[TNodeAsTuple]:
         neighbors = await self.find_node(self.source_node, to_find)
-        return self.handle_call_response(neighbors, self.source_node)
+        if neighbors:
+            return neighbors
+        return self._on_failure(self.source_node)
 
-    def handle_call_response(self, result: List[TNodeAsTuple], sender: PeerNode):
-        if not result:
-            return self.router.remove_node(sender)
-        return result
+    def _on_success(self, sender: PeerNode):
+        # checked here so that the common case of an already known peer
+        # doesn't go through welcome_node_if_new at all
+        if sender != self.source_node and self.router.is_new_node(sender):
+            self.welcome_node_if_new(sender)
+
+    def _on_failure(self, sender: PeerNode):
+        return self.router.remove_node(sender)
 
 
 class Server:
@@ -896,7 +1184,7 @@ class Server:
 
     def save_state_loop(self, frequency: int = 60):
         self.save_state()
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         self.save_state_loop = loop.call_later(frequency, self.save_state_loop)
 
 
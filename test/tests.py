@@ -12,11 +12,40 @@ class TestUtils:
     def test_bytes_to_bits_returns_proper_bit_string(self):
         pass
 
+    def test_gather_coros_maps_results_to_keys(self):
+        async def echo(x):
+            return x
+
+        for d in ({}, {"a": echo(1)}, {"a": echo(1), "b": echo(2)}):
+            expected = {k: i + 1 for i, k in enumerate(d)}
+            assert asyncio.run(gather_coros(d)) == expected
+
+    def test_run_returns_result_of_coroutine(self):
+        async def answer():
+            return 42
+
+        try:
+            assert run(answer()) == 42
+        finally:
+            # run() may have installed uvloop's policy, don't leak it into other tests
+            asyncio.set_event_loop_policy(None)
+
 class TestBaseNode:
     def test_create_node_sets_initialized_props(self):
         node = BaseNode(key="foo")
         assert isinstance(node.long_id, int)
 
+    def test_long_id_is_digest_as_int(self):
+        node = BaseNode(key="foo")
+        assert node.long_id == int.from_bytes(node.digest, "big")
+
+    def test_nodes_with_same_long_id_are_equal_and_hash_alike(self):
+        node1 = PeerNode(key="foo")
+        node2 = CacheNode(key="foo")
+
+        assert node1 == node2
+        assert len(set([node1, node2])) == 1
+
     def test_distance_to_returns_distance_from_long_ids(self):
         node1 = BaseNode(key="foo")
         node2 = BaseNode(key="bar")
@@ -40,6 +69,18 @@ class TestPeerNode:
 
         assert expected == node.serialize()
 
+    def test_addr_is_parsed_from_key_once(self):
+        node = PeerNode(key="127.0.0.1:8468")
+
+        assert node.addr == ("127.0.0.1", 8468)
+        assert node.addr is node.addr
+
+    def test_get_peer_node_reuses_live_instances(self):
+        node = get_peer_node("127.0.0.1:8468")
+
+        assert get_peer_node("127.0.0.1:8468") is node
+        assert get_peer_node("127.0.0.1:8469") is not node
+
 
 class TestCacheNode:
     def test_set_payload_sets_property_on_node(self):
@@ -140,6 +181,24 @@ class TestRoutingTable:
 
 
     
+    def test_find_neighbors_returns_k_closest_nodes(self, routing_table, generic_node):
+        table = routing_table()
+        for _ in range(10):
+            table.add_node(generic_node())
+        target = generic_node()
+
+        in_table = [n for bucket in table.buckets for n in bucket.get_main_set()]
+        expected = sorted(in_table, key=target.distance_to)[: table.ksize]
+        assert table.find_neighbors(target) == expected
+
+    def test_find_neighbors_skips_excluded_node(self, routing_table, generic_node):
+        table = routing_table()
+        nodes = [generic_node() for _ in range(3)]
+        for n in nodes:
+            table.add_node(n)
+
+        assert nodes[0] not in table.find_neighbors(nodes[0], exclude=nodes[0])
+
     @pytest.mark.skip(reason="Not finished")
     def test_remove_node_makes_bucket_remove_node(self, routing_table, generic_node):
         table = routing_table()
@@ -157,6 +216,101 @@ class TestRoutingTable:
         assert nodes[0] not in bucket.main_set
 
 
+class TestXORTrie:
+    def test_neighbors_are_ordered_by_distance_to_target(self, generic_node):
+        trie = XORTrie(2)
+        nodes = [generic_node() for _ in range(10)]
+        for n in nodes:
+            trie.insert(n)
+        target = generic_node()
+
+        expected = sorted(nodes, key=target.distance_to)[:4]
+        assert trie.neighbors(target.long_id, 4) == expected
+
+    def test_remove_drops_node_from_trie(self, generic_node):
+        trie = XORTrie(2)
+        nodes = [generic_node() for _ in range(5)]
+        for n in nodes:
+            trie.insert(n)
+        trie.remove(nodes[0])
+
+        assert len(trie) == 4
+        assert nodes[0] not in trie.neighbors(nodes[0].long_id, 5)
+
+
+class TestKademliaProtocol:
+    @staticmethod
+    def protocol_with_store_result(result):
+        protocol = KademliaProtocol(PeerNode(key=random_string()), CacheStorage(), KSIZE, wait=5)
+
+        async def store(requestee, payload):
+            return result
+
+        protocol.store = store
+        return protocol
+
+    def test_call_store_removes_unresponsive_peer(self):
+        protocol = self.protocol_with_store_result(None)
+        peer = PeerNode(key=random_string())
+        protocol.router.add_node(peer)
+
+        asyncio.run(protocol.call_store(peer, CacheNode(key=random_string())))
+
+        assert protocol.router.is_new_node(peer)
+
+    def test_call_store_welcomes_new_peer(self):
+        protocol = self.protocol_with_store_result(True)
+        peer = PeerNode(key=random_string())
+
+        assert asyncio.run(protocol.call_store(peer, CacheNode(key=random_string())))
+        assert not protocol.router.is_new_node(peer)
+
+    def test_call_store_never_welcomes_source_node(self):
+        protocol = self.protocol_with_store_result(True)
+        # a distinct instance, as an interned node for our own address would be
+        myself = PeerNode(key=protocol.source_node.key)
+
+        asyncio.run(protocol.call_store(myself, CacheNode(key=random_string())))
+
+        assert protocol.router.is_new_node(myself)
+
+    def test_rpc_stun_echoes_sender_address(self):
+        protocol = KademliaProtocol(PeerNode(key=random_string()), CacheStorage(), KSIZE, wait=5)
+        msg = Datagram(("127.0.0.1", 8468), b"\x00" * 21 + umsgpack.packb(["stun", []]))
+
+        result = asyncio.run(msg.exec_rpc_method(protocol.rpc_stun))
+
+        assert tuple(umsgpack.unpackb(umsgpack.packb(result))) == ("127.0.0.1", 8468)
+
+
+class TestRPCContainer:
+    def test_welcome_node_if_new_batches_stores_and_logs_failures(self, caplog):
+        protocol = KademliaProtocol(PeerNode(key=random_string()), CacheStorage(), KSIZE, wait=5)
+        for _ in range(STORE_BATCH_SIZE + 1):
+            protocol.storage.add_node(CacheNode(key=random_string()))
+
+        batches = []
+        log_failed_stores = protocol._log_failed_stores
+
+        def record_batch(stores):
+            batches.append(len(stores.result()))
+            log_failed_stores(stores)
+
+        protocol._log_failed_stores = record_batch
+
+        async def welcome():
+            protocol.welcome_node_if_new(PeerNode(key=random_string()))
+            for _ in range(5):
+                await asyncio.sleep(0)
+
+        asyncio.run(welcome())
+
+        # the table is empty, so every stored node is sent to the new peer;
+        # RPCContainer.store isn't implemented, so every store fails
+        assert batches == [STORE_BATCH_SIZE, 1]
+        assert caplog.text.count("call_store failed") == STORE_BATCH_SIZE + 1
+
+
 class TestNodeHeap:
     def test_can_create_node_heap(self, node_heap, generic_node):
         heap = node_heap()
@@ -171,3 +325,89 @@ class TestNodeHeap:
             heap.push(nodes)
 
         
+
+    def test_push_ignores_nodes_already_in_heap(self, node_heap, generic_node):
+        heap = node_heap()
+        node = generic_node()
+        heap.push([node])
+        heap.push([node])
+
+        assert len(heap.heap) == 1
+        assert node in heap
+        assert heap.get_node(node.long_id) is node
+
+    def test_remove_drops_nodes_from_heap(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(3)]
+        heap.push(list(nodes))
+        heap.remove([nodes[0]])
+
+        assert nodes[0] not in heap
+        assert nodes[1] in heap
+        assert heap.get_node(nodes[0].long_id) is None
+
+    def test_popleft_skips_removed_nodes(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(3)]
+        heap.push(list(nodes))
+
+        closest = list(heap)[0]
+        heap.remove([closest])
+
+        assert closest not in list(heap)
+        assert heap.popleft() is not closest
+        assert len(heap) == 1
+
+    def test_push_keeps_only_max_size_closest_nodes(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(10)]
+        for node in nodes:
+            heap.push([node])
+
+        expected = sorted(nodes, key=heap.source_node.distance_to)[: heap.max_size]
+        assert len(heap.heap) == heap.max_size
+        assert list(heap) == expected
+
+    def test_bulk_push_keeps_heap_ordered_by_distance(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(10)]
+        heap.push(nodes)
+
+        expected = sorted(nodes, key=heap.source_node.distance_to)[: heap.max_size]
+        assert list(heap) == expected
+
+    def test_removed_node_is_replaced_by_closest_evicted_node(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(5)]
+        heap.push(list(nodes))
+        closest = list(heap)[0]
+
+        heap.remove([closest])
+
+        expected = sorted(nodes, key=heap.source_node.distance_to)[1 : heap.max_size + 1]
+        assert len(heap) == heap.max_size
+        assert list(heap) == expected
+
+    def test_k_closest_ranks_nodes_by_distance_to_target(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(3)]
+        heap.push(list(nodes))
+        target = generic_node()
+
+        expected = sorted(nodes, key=target.distance_to)[:2]
+        assert heap.k_closest(target.long_id, 2) == expected
+
+    def test_uncontacted_skips_contacted_and_removed_nodes(self, node_heap, generic_node):
+        heap = node_heap()
+        nodes = [generic_node() for _ in range(3)]
+        heap.push(list(nodes))
+        closest, middle, furthest = list(heap)
+
+        heap.mark_contacted(closest)
+        heap.remove([furthest])
+
+        assert heap.uncontacted() == [middle]
+        assert not heap.has_exhausted_contacts()
+
+        heap.mark_contacted(middle)
+        assert heap.has_exhausted_contacts()